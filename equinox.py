@@ -1,17 +1,21 @@
 #!/usr/bin/python3
-from terminusdb_client import WOQLClient
-from terminusdb_client import WOQLQuery as WOQL
 import re
 import csv
+import io
 import json
-import math
 import os
 import sys
+import threading
 import urllib.parse
 import time
 
-from functools import reduce
-from difflib import SequenceMatcher
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from multiprocessing import Pool
+
+# Set EQUINOX_DEBUG=1 to dump the documents being sent to TerminusDB
+DEBUG = os.environ.get('EQUINOX_DEBUG') == '1'
 
 dbid = "seshat"
 label = "Seshat"
@@ -19,7 +23,7 @@ description = "A knowledge graph of human polities."
 prefixes = {'@base' : 'http://data.seshatdatabank.info/polities/',
             '@schema' : 'http://lib.seshatdatabank.info/schema#' }
 
-basic_schema = [
+basic_schema = (
     { "@type" : "Class",
       "@id" : "GeoCoordinate",
       "@subdocument" : [],
@@ -322,86 +326,103 @@ basic_schema = [
                          '@class' : 'PrecedingPolityRelationship' },
      },
 
-]
+)
+
+# All the date and date range forms accepted by date_range_object, tried in
+# order. Each alternative ends in its own named group, so m.lastgroup says
+# which form matched.
+_DATE_RANGE = re.compile(r'''^(?:
+      (?P<bce>\d+)\s*BCE
+    | (?P<ce>\d+)\s*C?E?
+    | (?P<bce_from>\d+)\s*(?:BCE\s*)?-\s*(?P<bce_to>\d+)\s*BCE
+    | (?P<ce_from>\d+)\s*-\s*(?P<ce_to>\d+)\s*C?E?
+    | (?P<ce_ce_from>\d+)\s*CE\s*-\s*(?P<ce_ce_to>\d+)\s*CE
+    | (?P<bce_ce_from>\d+)\s*BCE\s*-\s*(?P<bce_ce_to>\d+)\s*CE
+    )$''', re.VERBOSE)
+
+# lastgroup -> (from group, to group, from sign, to sign)
+_DATE_RANGE_FORMS = {
+    'bce' : ('bce', 'bce', -1, -1),
+    'ce' : ('ce', 'ce', 1, 1),
+    'bce_to' : ('bce_from', 'bce_to', -1, -1),
+    'ce_to' : ('ce_from', 'ce_to', 1, 1),
+    'ce_ce_to' : ('ce_ce_from', 'ce_ce_to', 1, 1),
+    'bce_ce_to' : ('bce_ce_from', 'bce_ce_to', -1, 1),
+}
+_YEAR = re.compile(r'^(\d+)\s*(BCE|CE)$')
+_INTEGER_RANGE = re.compile(r'(\d+)-(\d+)')
+
+_CENTRALIZATION_KEYWORDS = ('none', 'loose', 'nominal', 'unitary state',
+                            'confederated state', 'polity')
+_DATE_RANGE_PAT = re.compile(r'^\d+\s*B?C?E?\s*$|^\d+\s*B?C?E?\s*-\s*\d+\s*B?C?E?\s*$')
+
+_EPISTEMIC_PREFIXES = (
+    ('suspected unknown', 'suspected unknown'),
+    ('unknown', 'unknown'),
+    ('uncoded', 'unknown'),
+    ('known', 'known'),
+    ('inferred', 'inferred'),
+    ('disputed', 'disputed'),
+)
+
+_SUPRA_KEYWORDS = (
+    ('vassalage', 'vassalage'),
+    ('none', 'none'),
+    ('alliance', 'alliance'),
+    ('nominal', 'nominal'),
+)
+
+# Date ranges repeat heavily (centuries, reign dates), so identical ranges
+# share one DateRange subdocument. Callers must not mutate the result.
+@lru_cache(maxsize=4096)
+def date_range_dict(start, end):
+    return { '@type' : 'DateRange', 'from' : start, 'to' : end }
 
 def date_range_object(date_string):
-    date_string = date_string.upper()
-    bce_date = '^(\d+)\s*BCE$'
-    ce_date = '^(\d+)\s*C?E?$'
-
-    bce_date_range = '^(\d+)\s*-\s*(\d+)\s*BCE$|^(\d+)\s*BCE\s*-\s*(\d+)\s*BCE$'
-    ce_date_range = '^(\d+)\s*-\s*(\d+)\s*C?E?$|^(\d+)\s*CE\s*-\s*(\d+)\s*CE$$'
-    bce_ce_date_range = '^(\d+)\s*BCE\s*-\s*(\d+)\s*CE$'
-
-    m = re.match(bce_date,date_string)
-    if m:
-        from_time = - int(m[1])
-        to_time = from_time
-        return { '@type' : 'DateRange', 'from' : from_time, 'to' : to_time }
-
-    m = re.match(ce_date,date_string)
-    if m:
-        from_time = int(m[1])
-        to_time = from_time
-        return { '@type' : 'DateRange', 'from' : from_time, 'to' : to_time }
+    if date_string.isdecimal():
+        year = int(date_string)
+        return date_range_dict(year, year)
 
-    m = re.match(bce_date_range,date_string)
-    if m:
-        start = m[1] if m[1] else m[3]
-        end = m[2] if m[2] else m[4]
-        from_time = -int(start)
-        to_time = -int(end)
-        return { '@type' : 'DateRange', 'from' : from_time, 'to' : to_time }
-
-    m = re.match(ce_date_range,date_string)
-    if m:
-        start = m[1] if m[1] else m[3]
-        end = m[2] if m[2] else m[4]
-        from_time = int(start)
-        to_time = int(end)
-        return { '@type' : 'DateRange', 'from' : from_time, 'to' : to_time }
+    m = _DATE_RANGE.match(date_string.upper())
+    if not m:
+        raise Exception('Unable to parse date')
 
-    m = re.match(bce_ce_date_range,date_string)
-    if m:
-        start = m[1] if m[1] else m[3]
-        end = m[2] if m[2] else m[4]
-        from_time = int(start)
-        to_time = int(end)
-        return { '@type' : 'DateRange', 'from' : from_time, 'to' : to_time }
-
-    raise Exception('Unable to parse date')
+    (from_group, to_group, from_sign, to_sign) = _DATE_RANGE_FORMS[m.lastgroup]
+    from_time = from_sign * int(m[from_group])
+    to_time = to_sign * int(m[to_group])
+    return date_range_dict(from_time, to_time)
 
 def integer_from_to(value_from, value_to):
-    range_pat = "(\d+)-(\d+)"
-    m = re.match(range_pat, value_from)
+    m = _INTEGER_RANGE.match(value_from)
     if m:
-        start = int(m[1])
-        end = int(m[2])
-    elif re.match('\d+',value_from):
+        return (int(m[1]), int(m[2]))
+    if value_from[:1].isdecimal():
         start = int(value_from)
-        if re.match('\d+',value_to):
-            end = int(value_to)
-        else:
-            end = start
-    elif re.match('\d+',value_to):
+        end = int(value_to) if value_to[:1].isdecimal() else start
+        return (start, end)
+    if value_to[:1].isdecimal():
         end = int(value_to)
-        start = end
-    else:
-        return None
-    return [start, end]
+        return (end, end)
+    return None
 
 def date_gyear(date_string):
-    bce_date = '^(\d+)\s*BCE$'
-    ce_date = '^(\d+)\s*CE$'
     if date_string == '':
         return None
 
-    m = re.match(bce_date,date_string)
+    # Happy path: "<digits> CE" / "<digits> BCE" by slicing, regex otherwise
+    if date_string.endswith('BCE'):
+        digits = date_string[:-3].rstrip()
+        if digits.isdecimal():
+            return - int(digits)
+    elif date_string.endswith('CE'):
+        digits = date_string[:-2].rstrip()
+        if digits.isdecimal():
+            return int(digits)
+
+    m = _YEAR.match(date_string)
     if m:
-        return - int(m[1])
-    m = re.match(ce_date,date_string)
-    if m:
-        return int(m[1])
+        year = int(m[1])
+        return - year if m[2] == 'BCE' else year
 
     raise Exception(f"Could not parse date: {date_string}")
 
@@ -419,17 +440,10 @@ def date_from_to(value_from, value_to):
     return (start,end)
 
 def epistemic(value):
-    if re.match('suspected unknown', value):
-        return 'suspected unknown'
-    elif re.match('unknown',value) or re.match('uncoded',value):
-        return 'unknown'
-    elif re.match('known',value):
-        return 'known'
-    elif re.match('inferred',value):
-        return 'inferred'
-    elif re.match('disputed',value):
-        return 'disputed'
-    elif value == '':
+    for prefix, state in _EPISTEMIC_PREFIXES:
+        if value.startswith(prefix):
+            return state
+    if value == '':
         return None
     else:
         return 'known' # Is this correct?
@@ -463,41 +477,36 @@ def centralization(value):
 
 def presence(value):
     value = value.lower()
-    if re.match('.*present', value):
+    if 'present' in value:
         return 'present'
-    elif re.match('.*absent',value):
+    elif 'absent' in value:
         return 'absent'
     else:
         return None
 
 def supra_polity_relations(value):
     value = value.lower()
-    if re.match('.*vassalage', value):
-        return 'vassalage'
-    elif re.match('.*none',value):
-        return 'none'
-    elif re.match('.*alliance',value):
-        return 'alliance'
-    elif re.match('.*nominal', value):
-        return 'nominal'
-    elif value == '':
+    for keyword, relation in _SUPRA_KEYWORDS:
+        if keyword in value:
+            return relation
+    if value == '':
         return None
     else:
         return value
 
+@lru_cache(maxsize=None)
 def prop_name(name):
-    return urllib.parse.quote(name.lower().replace(' ', '_'))
+    return sys.intern(urllib.parse.quote(name.lower().replace(' ', '_')))
 
+@lru_cache(maxsize=None)
 def class_name(name):
-    return urllib.parse.quote(name.title().replace(' ', ''))
+    return sys.intern(urllib.parse.quote(name.title().replace(' ', '')))
 
 def epistemic_instance(var_obj,value_type,epistemic_state,value,date_range):
     value_obj = {'@type' : value_type, 'value' : value}
     if date_range:
         start,end = date_range
-        value_obj['date_range'] = { '@type' : 'DateRange',
-                                    'from' : start,
-                                    'to' : end}
+        value_obj['date_range'] = date_range_dict(start,end)
     if value is None:
         var_obj['unknown'] = []
         return var_obj
@@ -520,13 +529,24 @@ Polity_List = ['preceding (quasi)polity',
                'succeeding (quasi)polity']
 
 class Schema:
+    __slots__ = ('sections', 'subsections', 'variables', 'prop',
+                 '_variable_handler', '_registered_rows', '_registered_sections')
+
     def __init__(self):
         self.sections = {}
         self.subsections = {}
         self.variables = {}
         self.prop = {}
+        self._variable_handler = {}
+        self._registered_rows = set()
+        self._registered_sections = set()
 
     def register(self,section,subsection):
+        key = (section,subsection)
+        if key in self._registered_sections:
+            return subsection if subsection != '' else section
+        self._registered_sections.add(key)
+
         section_class = class_name(section)
         section_prop = prop_name(section)
         subsection_class = class_name(subsection)
@@ -554,11 +574,6 @@ class Schema:
 
 
     def infer_type(self,variable,value_from,value_to,value_note,section):
-        integer_pat = '^\s*\d+\s*$'
-        presence_pat = '^.*present.*$|^.*absent.*$'
-        centralization_pat = '^.*none.*$|^.*loose.*$|^.*nominal.*$|^.*unitary state.*$|^.*confederated state.*$|^.*quasi-polity.*$|^.*polity.*$'
-        date_range_pat = '^\d+\s*B?C?E?\s*$|^\d+\s*B?C?E?\s*-\s*\d+\s*B?C?E?\s*$'
-
         if variable in self.variables:
             # We may need to upgrade here...
             return self.variables[variable]
@@ -568,14 +583,14 @@ class Schema:
             return epistemic_family(variable,section,'CapitalValue')
         elif variable == 'Supra-polity relations':
             return epistemic_family(variable,section,'SupraPolityRelationsValue')
-        elif re.match(integer_pat, value_from):
+        elif value_from.strip().isdecimal():
             return epistemic_family(variable,section,'IntegerValue')
-        elif re.match(presence_pat, value_from):
+        elif 'present' in value_from or 'absent' in value_from:
             return epistemic_family(variable,section,'PresenceValue')
         elif (variable == 'Degree of centralization'
-              or re.match(centralization_pat,value_from)):
+              or any(keyword in value_from for keyword in _CENTRALIZATION_KEYWORDS)):
             return epistemic_family(variable,section,'CentralizationValue')
-        elif re.match(date_range_pat,value_from):
+        elif _DATE_RANGE_PAT.match(value_from):
             return epistemic_family(variable,section,'DateRangeValue')
         else:
             return epistemic_family(variable,section,'StringValue')
@@ -601,21 +616,46 @@ class Schema:
         ty = self.infer_type(variable,value_from,value_to,value_note,section_class)
         variable_class = class_name(variable)
         variable_prop = prop_name(variable)
-        if section_class in self.sections:
-            self.sections[section_class][variable_prop] = {'@type' : 'Set',
-                                                           '@class' : variable_class }
-        elif section_class in self.subsections:
-            section_class_def = self.subsections[section_class]
-            self.subsections[section_class][variable_prop] = {'@type' : 'Set',
-                                                              '@class' : variable_class}
-        else:
+        section_def = self.sections.get(section_class)
+        if section_def is None:
+            section_def = self.subsections.get(section_class)
+        if section_def is None:
             raise Exception(f"Unknown section title: {section_class}")
+        section_def[variable_prop] = {'@type' : 'Set',
+                                      '@class' : variable_class }
 
         self.variables[variable] = ty
+        value_type = Epistemic_Value_Map[ty['@inherits']]
+        try:
+            self._variable_handler[variable] = self._VALUE_TYPE_HANDLERS[value_type]
+        except KeyError:
+            raise Exception(f"Unknown Value Type {value_type} for {variable}")
 
         family = self.infer_family(ty['@id'],value_note,date_note)
         self.prop[variable] = family
 
+    # Only the first row for a (section, subsection, variable) decides its
+    # type and where it lives in the schema, so repeats are skipped.
+    def register_row(self,row):
+        section = row[2]
+        subsection = row[3]
+        variable = row[4]
+        key = (section,subsection,variable)
+        if key in self._registered_rows:
+            return
+        self._registered_rows.add(key)
+        section_class = self.register(section,subsection)
+        self.register_variable(variable,
+                               row[5], # value_from
+                               row[6], # value_to
+                               row[7], # date_from
+                               row[8], # date_to
+                               row[9], # fact_type
+                               row[10], # value_note
+                               row[11], # date_note
+                               row[12], # error_note
+                               section_class)
+
     def dump_polity(self):
         polity = {'@type' : 'Class',
                   '@id' : 'Polity'}
@@ -626,135 +666,127 @@ class Schema:
         return polity
 
     def dump_schema(self):
-        polity = self.dump_polity()
-        elements = [polity]
-        keys = []
-        for var in self.variables:
-            elements.append(self.variables[var])
-        for key in self.sections:
-            elements.append(self.sections[key])
-        for key in self.subsections:
-            elements.append(self.subsections[key])
+        elements = [self.dump_polity()]
+        elements.extend(self.variables.values())
+        elements.extend(self.sections.values())
+        elements.extend(self.subsections.values())
         return elements
 
     def infer_value(self,var_obj,variable,value_from,value_to,date_from,date_to,fact_type):
-        value_type = Epistemic_Value_Map[self.variables[variable]['@inherits']]
-        if 'StringValue' == value_type:
-            date_range = date_from_to(date_from,date_to)
-            epistemic_state = epistemic(value_from)
-            return epistemic_instance(var_obj,value_type,epistemic_state,value_from,date_range)
-        elif 'IntegerRangeValue' == value_type:
-            date_range = date_from_to(date_from,date_to)
-            epistemic_state = epistemic(value_from)
-            integer_range = integer_from_to(value_from,value_to)
-            return epistemic_instance(var_obj,value_type,epistemic_state,integer_range,date_range)
-        elif 'IntegerValue' == value_type:
-            date_range = date_from_to(date_from,date_to)
-            epistemic_state = epistemic(value_from)
-            integer_range = integer_from_to(value_from,value_to)
-            if integer_range:
-                (start,end) = integer_range
-            else:
-                start = None
-            return epistemic_instance(var_obj,value_type,epistemic_state,start,date_range)
-        elif 'DateRangeValue' == value_type:
-            epistemic_state = epistemic(value_from)
-            if epistemic_state == 'unknown':
-                date_range = None
-            else:
-                date_range = date_range_object(value_from)
-            return epistemic_instance(var_obj,value_type,epistemic_state,date_range,None)
-        elif 'CapitalValue' == value_type:
-            date_range = date_from_to(date_from,date_to)
-            epistemic_state = epistemic(value_from)
-            if value_from != '':
-                 city = { '@type' : 'City',
-                          'name' : value_from }
-                 return epistemic_instance(var_obj,value_type,epistemic_state,city,date_range)
-            else:
-                return None
-        elif 'PresenceValue' == value_type:
-            date_range = date_from_to(date_from,date_to)
-            epistemic_state = epistemic(value_from)
-            presence_state = presence(value_from)
-            return epistemic_instance(var_obj,value_type,epistemic_state,presence_state,date_range)
-        elif 'CentralizationValue' == value_type:
-            date_range = date_from_to(date_from,date_to)
-            epistemic_state = epistemic(value_from)
-            centralization_state = centralization(value_from)
-            return epistemic_instance(var_obj,value_type,epistemic_state,centralization_state,date_range)
-        elif 'SupraPolityRelationsValue' == value_type:
-            date_range = date_from_to(date_from,date_to)
-            epistemic_state = epistemic(value_from)
-            supra_state = supra_polity_relations(value_from)
-            return epistemic_instance(var_obj,value_type,epistemic_state,supra_state,date_range)
+        handler = self._variable_handler[variable]
+        epistemic_state = epistemic(value_from)
+        return handler(self,var_obj,epistemic_state,value_from,value_to,date_from,date_to)
+
+    def _infer_string(self,var_obj,epistemic_state,value_from,value_to,date_from,date_to):
+        date_range = date_from_to(date_from,date_to)
+        return epistemic_instance(var_obj,'StringValue',epistemic_state,value_from,date_range)
+
+    def _infer_integer_range(self,var_obj,epistemic_state,value_from,value_to,date_from,date_to):
+        date_range = date_from_to(date_from,date_to)
+        integer_range = integer_from_to(value_from,value_to)
+        return epistemic_instance(var_obj,'IntegerRangeValue',epistemic_state,integer_range,date_range)
+
+    def _infer_integer(self,var_obj,epistemic_state,value_from,value_to,date_from,date_to):
+        date_range = date_from_to(date_from,date_to)
+        integer_range = integer_from_to(value_from,value_to)
+        if integer_range:
+            (start,end) = integer_range
         else:
-            raise Exception(f"Unknown Value Type {value_type} for {variable}")
+            start = None
+        return epistemic_instance(var_obj,'IntegerValue',epistemic_state,start,date_range)
 
-        return var_obj
+    def _infer_date_range(self,var_obj,epistemic_state,value_from,value_to,date_from,date_to):
+        if epistemic_state == 'unknown':
+            date_range = None
+        else:
+            date_range = date_range_object(value_from)
+        return epistemic_instance(var_obj,'DateRangeValue',epistemic_state,date_range,None)
+
+    def _infer_capital(self,var_obj,epistemic_state,value_from,value_to,date_from,date_to):
+        date_range = date_from_to(date_from,date_to)
+        if value_from != '':
+            city = { '@type' : 'City',
+                     'name' : value_from }
+            return epistemic_instance(var_obj,'CapitalValue',epistemic_state,city,date_range)
+        else:
+            return None
+
+    def _infer_presence(self,var_obj,epistemic_state,value_from,value_to,date_from,date_to):
+        date_range = date_from_to(date_from,date_to)
+        presence_state = presence(value_from)
+        return epistemic_instance(var_obj,'PresenceValue',epistemic_state,presence_state,date_range)
+
+    def _infer_centralization(self,var_obj,epistemic_state,value_from,value_to,date_from,date_to):
+        date_range = date_from_to(date_from,date_to)
+        centralization_state = centralization(value_from)
+        return epistemic_instance(var_obj,'CentralizationValue',epistemic_state,centralization_state,date_range)
+
+    def _infer_supra_polity_relations(self,var_obj,epistemic_state,value_from,value_to,date_from,date_to):
+        date_range = date_from_to(date_from,date_to)
+        supra_state = supra_polity_relations(value_from)
+        return epistemic_instance(var_obj,'SupraPolityRelationsValue',epistemic_state,supra_state,date_range)
+
+    _VALUE_TYPE_HANDLERS = {
+        'StringValue' : _infer_string,
+        'IntegerRangeValue' : _infer_integer_range,
+        'IntegerValue' : _infer_integer,
+        'DateRangeValue' : _infer_date_range,
+        'CapitalValue' : _infer_capital,
+        'PresenceValue' : _infer_presence,
+        'CentralizationValue' : _infer_centralization,
+        'SupraPolityRelationsValue' : _infer_supra_polity_relations,
+    }
 
 def extend_polity(polity, section, subsection, variable, value):
+    _extend_polity_precomputed(polity,
+                               prop_name(section), class_name(section),
+                               subsection, prop_name(subsection), class_name(subsection),
+                               prop_name(variable), value)
+
+def _extend_polity_precomputed(polity, section_prop, section_class,
+                               subsection, subsection_prop, subsection_class,
+                               variable_prop, value):
     if value is None:
         return
 
-    variable_class = class_name(variable)
-    variable_prop = prop_name(variable)
-    section_class = class_name(section)
-    section_prop = prop_name(section)
-    subsection_class = class_name(subsection)
-    subsection_prop = prop_name(subsection)
-
-    if not (section_prop in polity):
-        polity[section_prop] = { '@type' : section_class }
-
+    section_obj = polity.setdefault(section_prop, { '@type' : section_class })
     if subsection != '':
-        if subsection_prop not in polity[section_prop]:
-            subsection_obj = {'@type' : subsection_class}
-            polity[section_prop][subsection_prop] = subsection_obj
-        else:
-            subsection_obj = polity[section_prop][subsection_prop]
-
-        #print(f"subsection_obj: {subsection_obj}")
-        if variable_prop in subsection_obj:
-            subsection_obj[variable_prop].append(value)
-        else:
-            subsection_obj[variable_prop] = [value]
-        #polity[section_prop][subsection_prop][variable_prop] = variable_obj
+        target = section_obj.setdefault(subsection_prop, { '@type' : subsection_class })
     else:
-        section_obj = polity[section_prop]
-
-        if variable_prop in section_obj:
-            section_obj[variable_prop].append(value)
-        else:
-            section_obj[variable_prop] = [value]
-        #polity[section_prop][variable_prop] = value
-
-def infer_schema(csvpath):
-    schema = Schema()
-    with open(csvpath, newline='') as csvfile:
+        target = section_obj
+    target.setdefault(variable_prop, []).append(value)
+
+# Columns: NGA|Polity|Section|Subsection|Variable|Value From|Value To|
+#          Date From|Date To|Fact Type|Value Note|Date Note|Error Note
+#
+# Yield the data rows of a Seshat CSV export with the section and
+# subsection columns title-cased. There are only a few dozen distinct
+# section names, so each is title-cased once and looked up thereafter.
+# Polity, section, subsection and variable names are interned so that
+# every row shares one string object per name.
+def read_rows(csvpath):
+    titles = {}
+    with open(csvpath, 'rb', buffering=1 << 20) as binfile:
+        csvfile = io.TextIOWrapper(binfile, encoding='utf-8', newline='')
         next(csvfile) # drop header
-        rows = csv.reader(csvfile, delimiter='|')
-        for row in rows:
-            (nga,polity,section,subsection,variable,value_from,value_to,
-             date_from,date_to,fact_type,value_node,date_note,error_note) = row
-            section = section.title()
-            subsection = subsection.title()
-            variable_class = class_name(variable)
-            variable_prop = prop_name(variable)
-            if polity == 'Code book':
-                pass # special case?
-            else:
-                section_class = schema.register(section,subsection)
-                schema.register_variable(variable,
-                                         value_from,
-                                         value_to,
-                                         date_from,
-                                         date_to,
-                                         fact_type,
-                                         value_node,
-                                         date_note,
-                                         error_note,
-                                         section_class)
+        for row in csv.reader(csvfile, delimiter='|'):
+            for i in (2, 3):
+                raw = row[i]
+                titled = titles.get(raw)
+                if titled is None:
+                    titled = titles[raw] = sys.intern(raw.title())
+                row[i] = titled
+            row[1] = sys.intern(row[1])
+            row[4] = sys.intern(row[4])
+            yield row
+
+def infer_schema(rows):
+    schema = Schema()
+    for row in rows:
+        if row[1] == 'Code book':
+            pass # special case?
+        else:
+            schema.register_row(row)
     return schema
 
 def import_schema(client,schema_objects):
@@ -762,105 +794,193 @@ def import_schema(client,schema_objects):
                                      graph_type="schema")
     print(f"Added schema objects: {results}")
 
-def load_data(csvpath,schema):
-    with open(csvpath, newline='') as csvfile:
-        next(csvfile) # drop header
-        rows = csv.reader(csvfile, delimiter='|')
-        polities = []
-        this_polity = { '@id' : None }
-        var_obj = { '@type' : None }
-        for row in rows:
-            (nga,polity,section,subsection,variable,value_from,value_to,
-             date_from,date_to,fact_type,value_note,date_note,error_note) = row
-            if polity == 'Code book' or variable in Polity_List:
-                continue # string out of band value
-            section = section.title()
-            subsection = subsection.title()
-            variable_class = class_name(variable)
-            variable_prop = prop_name(variable)
-            section_class = class_name(section)
-            section_prop = prop_name(section)
-            subsection_class = class_name(subsection)
-            subsection_prop = prop_name(subsection)
-
-            if not ('Polity/' + polity == this_polity['@id']):
-                this_polity = { '@id' : 'Polity/' + polity,
-                                '@type' : 'Polity' }
-                polities.append(this_polity)
-
-            var_obj = { '@type' : variable_class }
-            value = schema.infer_value(var_obj,
-                                       variable,
-                                       value_from,
-                                       value_to,
-                                       date_from,
-                                       date_to,
-                                       value_note)
-            extend_polity(this_polity, section, subsection, variable, var_obj)
-
-        return polities
-
-def import_data(client,objects):
-    chunk_size = 10
-    size = len(objects)
-    chunks = (len(objects) + 1) // chunk_size
-    for m in range(0,chunks):
-        start_time = time.time()
-        object_slice = objects[m * chunk_size: min((m+1) * chunk_size, size)]
-        #print(json.dumps(object_slice, indent=4))
-        results = client.insert_document(object_slice)
-        #results = client.insert_document(document)
-        print(f"Added documents: {results}")
-        elapsed_time = (time.time() - start_time)
-        time_per_polity = (elapsed_time/chunk_size)
-        print(f"Creation and insert execution time for {chunk_size} polities: {elapsed_time}s ({time_per_polity}s/test polity)")
-
-def connect_polities(client,csvpath):
-    with open(csvpath, newline='') as csvfile:
-        next(csvfile) # drop header
-        rows = csv.reader(csvfile, delimiter='|')
-        for row in rows:
-            (nga,polity,section,subsection,variable,value_from,value_to,
-             date_from,date_to,fact_type,value_note,date_note,error_note) = row
-
-            if variable in Polity_List:
-                poluri,name = WOQL().vars("Polity_URI","Name")
-                query = WOQL().limit(1,
-                                     ( (WOQL().path(poluri,
-                                                    "general_variables,original_name,known,value",
-                                                    WOQL().string(value_from))
-                                        | WOQL().path(poluri,
-                                                      "general_variables,alternative_names,known,value",
-                                                      WOQL().string(value_from)))))
-
-                results = client.query(query)
-                if len(results['bindings']) == 1:
-                    other_polity_uri = results['bindings'][0]['Polity_URI']
-                    polity_uri = f"Polity/{polity}"
-                    other_polity = other_polity_uri.split('/')[-1]
-                    if variable == 'preceding (quasi)polity':
-                        before_uri = other_polity_uri
-                        before = other_polity
-                        after_uri = polity_uri
-                        after = polity
-                    elif variable == 'succeeding (quasi)polity':
-                        before_uri = polity_uri
-                        before = polity
-                        after_uri = other_polity_uri
-                        after = other_polity
+@lru_cache(maxsize=None)
+def polity_names(section, subsection, variable):
+    return (class_name(variable),
+            prop_name(section), class_name(section),
+            prop_name(subsection), class_name(subsection),
+            prop_name(variable))
+
+# Build the document for one polity from all of its CSV rows
+def build_polity(schema, polity, rows):
+    this_polity = { '@id' : 'Polity/' + polity,
+                    '@type' : 'Polity' }
+    for row in rows:
+        section = row[2]
+        subsection = row[3]
+        variable = row[4]
+        (variable_class, section_prop, section_class,
+         subsection_prop, subsection_class, variable_prop) = polity_names(section, subsection, variable)
+
+        var_obj = { '@type' : variable_class }
+        value = schema.infer_value(var_obj,
+                                   variable,
+                                   row[5], # value_from
+                                   row[6], # value_to
+                                   row[7], # date_from
+                                   row[8], # date_to
+                                   row[10]) # value_note
+        _extend_polity_precomputed(this_polity, section_prop, section_class,
+                                   subsection, subsection_prop, subsection_class,
+                                   variable_prop, var_obj)
+    return this_polity
+
+_worker_schema = None
+
+def _init_worker(schema):
+    global _worker_schema
+    _worker_schema = schema
+
+def _build_polity_in_worker(item):
+    (polity, rows) = item
+    return build_polity(_worker_schema, polity, rows)
+
+# Polities are independent once the schema is known, so with processes > 1
+# they are built in a process pool. The schema is shipped to each worker
+# once and the polities come back in the order they first appear in the CSV.
+# Documents are generated lazily, so they can be inserted as they are built
+# rather than all being held in memory first.
+def build_polities(schema,rows_by_polity,processes=1):
+    if processes == 1:
+        for polity, rows in rows_by_polity.items():
+            yield build_polity(schema, polity, rows)
+        return
 
+    with Pool(processes, initializer=_init_worker, initargs=(schema,)) as pool:
+        yield from pool.imap(_build_polity_in_worker, rows_by_polity.items(),
+                             chunksize=16)
+
+def load_data(rows,schema,processes=1):
+    rows_by_polity = {}
+    for row in rows:
+        polity = row[1]
+        variable = row[4]
+        if polity == 'Code book' or variable in Polity_List:
+            continue # string out of band value
+        if not (row[5] or row[6] or row[7] or row[8]):
+            continue # no value or date to record
+        rows_by_polity.setdefault(polity, []).append(row)
+    return build_polities(schema,rows_by_polity,processes)
+
+# infer_schema and load_data in a single pass over the rows. A variable's
+# type is fixed by the first row that registers it, so the rows can be
+# grouped by polity while the schema is still being built.
+def parse_csv(rows,processes=1):
+    schema = Schema()
+    rows_by_polity = {}
+    for row in rows:
+        polity = row[1]
+        if polity == 'Code book':
+            continue
+        schema.register_row(row)
+        if row[4] in Polity_List:
+            continue # string out of band value
+        if not (row[5] or row[6] or row[7] or row[8]):
+            continue # no value or date to record
+        rows_by_polity.setdefault(polity, []).append(row)
+    return (schema, build_polities(schema,rows_by_polity,processes))
+
+def insert_chunk(client,object_slice):
+    start_time = time.time()
+    if DEBUG:
+        print(json.dumps(object_slice, indent=4))
+    results = client.insert_document(object_slice)
+    return (results, len(object_slice), time.time() - start_time)
+
+def report_chunk(future):
+    (results, count, elapsed_time) = future.result()
+    print(f"Added documents: {results}")
+    time_per_polity = (elapsed_time/count)
+    print(f"Creation and insert execution time for {count} polities: {elapsed_time}s ({time_per_polity}s/test polity)")
+
+def batches(objects,chunk_size):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Keeps up to max_in_flight chunks in flight, so further requests are being
+# sent while the server is still working on earlier ones. objects may be any
+# iterable, including the generator returned by load_data. WOQLClient is not
+# meant to be shared between threads, so given a client_factory each worker
+# thread connects its own client; otherwise client is used for every insert.
+def import_data(client,objects,chunk_size=100,max_in_flight=2,client_factory=None):
+    local = threading.local()
+
+    def init_worker():
+        local.client = client_factory() if client_factory else client
+
+    def insert(object_slice):
+        return insert_chunk(local.client, object_slice)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight,
+                            initializer=init_worker) as executor:
+        pending = deque()
+        for object_slice in batches(objects,chunk_size):
+            if len(pending) == max_in_flight:
+                report_chunk(pending.popleft())
+            pending.append(executor.submit(insert, object_slice))
+        while pending:
+            report_chunk(pending.popleft())
+
+# Map every original and alternative polity name to its polity URI.
+# Original names take precedence, as they did in the per-name query.
+def polity_name_index(client):
+    from terminusdb_client import WOQLQuery as WOQL
+    name_to_uri = {}
+    for path in ["general_variables,original_name,known,value",
+                 "general_variables,alternative_names,known,value"]:
+        poluri,name = WOQL().vars("Polity_URI","Name")
+        results = client.query(WOQL().path(poluri, path, name))
+        for binding in results['bindings']:
+            name_to_uri.setdefault(binding['Name']['@value'], binding['Polity_URI'])
+    return name_to_uri
+
+def connect_polities(client,rows):
+    name_to_uri = polity_name_index(client)
+    relationships_by_uri = {}
+    for row in rows:
+        polity = row[1]
+        variable = row[4]
+        value_from = row[5]
+
+        if variable in Polity_List:
+            other_polity_uri = name_to_uri.get(value_from)
+            if other_polity_uri:
+                polity_uri = f"Polity/{polity}"
+                other_polity = other_polity_uri.split('/')[-1]
+                if variable == 'preceding (quasi)polity':
+                    before_uri = other_polity_uri
+                    before = other_polity
+                    after_uri = polity_uri
+                    after = polity
+                elif variable == 'succeeding (quasi)polity':
+                    before_uri = polity_uri
+                    before = polity
+                    after_uri = other_polity_uri
+                    after = other_polity
+
+                relationships = relationships_by_uri.get(after_uri)
+                if relationships is None:
                     relationships = get_previous_relationships(client,after_uri)
+                    relationships_by_uri[after_uri] = relationships
+                if DEBUG:
                     print(f"relationships: {relationships}")
-                    document = { '@id' : f"PrecedingPolity/{before}_{after}",
-                                 '@type' : 'PrecedingPolity',
-                                 'preceding' : before_uri,
-                                 'polity' : after_uri,
-                                 'relationship' : relationships
-                                }
-                    results = client.update_document(document)
-                    print(f"adding preceding: {before} => {after}")
+                document = { '@id' : f"PrecedingPolity/{before}_{after}",
+                             '@type' : 'PrecedingPolity',
+                             'preceding' : before_uri,
+                             'polity' : after_uri,
+                             'relationship' : relationships
+                            }
+                results = client.update_document(document)
+                print(f"adding preceding: {before} => {after}")
 
 def get_previous_relationships(client,after_uri):
+    from terminusdb_client import WOQLQuery as WOQL
     relationship = WOQL().vars('relationship')
     query = WOQL().path(after_uri,'general_variables,relationship_to_preceding_%28quasi%29polity,known,value', relationship)
     results = client.query(query)
@@ -871,6 +991,7 @@ def get_previous_relationships(client,after_uri):
     return relationships
 
 def delete_relationships(client):
+    from terminusdb_client import WOQLQuery as WOQL
     query = WOQL().triple("v:ID","rdf:type","@schema:PrecedingPolity")
     result = client.query(query)
     ids = []
@@ -878,8 +999,10 @@ def delete_relationships(client):
         ids.append(res['ID'])
     client.delete_document(ids)
 
-def run():
-    csvpath = "equinox.csv"
+# Connect to the TerminusDB server described by the environment, optionally
+# straight to database db
+def connect_client(db=None):
+    from terminusdb_client import WOQLClient
     key = os.environ['TERMINUSDB_ACCESS_TOKEN']
     endpoint = os.environ['TERMINUSDB_ENDPOINT']
     team = os.environ['TERMINUSDB_TEAM']
@@ -896,12 +1019,18 @@ def run():
     use_token = True
     if key == 'false':
         use_token = False
-        client.connect(user='admin', team=team, use_token=use_token)
+        client.connect(user='admin', team=team, db=db, use_token=use_token)
     else:
-        client.connect(team=team, use_token=use_token)
+        client.connect(team=team, db=db, use_token=use_token)
+    return client
+
+def run():
+    csvpath = "equinox.csv"
+    team = os.environ['TERMINUSDB_TEAM']
+    client = connect_client()
 
     # use when not recreating
-    # client.connect(db=dbid,team=team,use_token=use_token)
+    # client = connect_client(db=dbid)
 
     exists = client.get_database(dbid)
     if exists:
@@ -913,17 +1042,21 @@ def run():
                            description=description,
                            prefixes=prefixes)
 
-    schema = infer_schema(csvpath)
-    schema_objects = basic_schema + schema.dump_schema()
-    #print(json.dumps(schema_objects, indent=4))
+    # Parse the CSV once; the schema, the polity documents and the
+    # polity connections are all built from the same rows.
+    rows = list(read_rows(csvpath))
+    polity_links = [row for row in rows if row[4] in Polity_List]
+
+    (schema, objects) = parse_csv(rows)
+    schema_objects = [*basic_schema, *schema.dump_schema()]
+    if DEBUG:
+        print(json.dumps(schema_objects, indent=4))
     import_schema(client,schema_objects)
-    objects = load_data(csvpath,schema)
-    # print(json.dumps(objects, indent=4))
-    import_data(client,objects)
+    import_data(client,objects,client_factory=lambda: connect_client(db=dbid))
     # If you need to start over with connections...
     # delete_relationships(client)
 
-    connect_polities(client,csvpath)
+    connect_polities(client,polity_links)
 
 if __name__ == "__main__":
     run()